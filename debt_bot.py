@@ -5,8 +5,11 @@ Telegram Bot для учета долгов сотрудников
 """
 
 import logging
-import asyncio
-from datetime import datetime, timedelta
+import os
+import pickle
+from array import array
+from collections import defaultdict
+from datetime import datetime, time as dt_time, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
@@ -15,9 +18,21 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
-import schedule
+import google_auth_httplib2
+import httplib2
+import httpx
 import time
-from threading import Thread
+
+# Numba не обязательна: при наличии JIT-компилирует ядро агрегации,
+# без неё то же ядро работает обычным Python-циклом
+try:
+    from numba import njit
+except ImportError:
+    def njit(**kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
 from config import (
     TELEGRAM_TOKEN, GOOGLE_API_KEY, SPREADSHEET_ID,
     ADMIN_IDS, ENABLE_NOTIFICATIONS, ENABLE_LOGGING,
@@ -41,10 +56,67 @@ SHEET_NAMES = {
     'admins': 'admins'
 }
 
+# Реально используемые колонки каждого листа — читаем только их
+SHEET_RANGES = {
+    'employees': 'A:B',  # id, имя
+    'debts': 'A:E',      # дата, сотрудник, позиции, сумма, месяц
+    'admins': 'A:A'      # id
+}
+
+# Время жизни кэша прочитанных листов (секунды)
+CACHE_TTL = 60
+
+# Время жизни роли пользователя в context.user_data (секунды)
+ROLE_CACHE_TTL = 300
+
+# Снимок кэша листов для тёплого старта после перезапуска
+CACHE_FILE = 'cache.pkl'
+
+# REST-эндпоинт Sheets API для асинхронных запросов
+SHEETS_API_BASE = "https://sheets.googleapis.com/v4/spreadsheets"
+
+# Номера месяцев для разбора строк вида "December 2024" (формат %B %Y)
+MONTH_NUMBERS = {
+    'January': 1, 'February': 2, 'March': 3, 'April': 4,
+    'May': 5, 'June': 6, 'July': 7, 'August': 8,
+    'September': 9, 'October': 10, 'November': 11, 'December': 12
+}
+
+def _month_key(month_str):
+    """Преобразование месяца "December 2024" в целочисленный ключ 202412
+
+    Возвращает 0, если строка не разбирается — такой ключ не совпадет
+    ни с одним реальным месяцем.
+    """
+    try:
+        name, year = month_str.split()
+        return int(year) * 100 + MONTH_NUMBERS[name]
+    except (ValueError, KeyError):
+        return 0
+
+@njit(cache=True)
+def _aggregate_debts(amounts, emp_ids, month_ids, want_emp, want_month):
+    """Сумма долгов по паре (сотрудник, месяц) — чистое числовое ядро"""
+    total = 0.0
+    for i in range(len(amounts)):
+        if emp_ids[i] == want_emp and month_ids[i] == want_month:
+            total += amounts[i]
+    return total
+
 class DebtBot:
     def __init__(self):
         self.service = None
+        # Кэш прочитанных листов: (sheet_name, range_name) -> (timestamp, rows)
+        self._cache = {}
+        # Индексы для O(1) поиска по user_id (строятся лениво из кэша)
+        self._role_index = None
+        self._name_index = None
+        # Колонки листа debts (structure-of-arrays, строятся лениво из кэша)
+        self._debts_columns = None
+        # Асинхронный HTTP-клиент (httpx уже идет в комплекте с PTB)
+        self._http = None
         self.setup_google_sheets()
+        self._load_cache_snapshot()
     
     def setup_google_sheets(self):
         """Настройка подключения к Google Sheets"""
@@ -68,33 +140,188 @@ class DebtBot:
                 scopes=GOOGLE_SCOPES
             )
             
-            self.service = build('sheets', 'v4', credentials=credentials, developerKey=GOOGLE_API_KEY)
+            # Долгоживущий транспорт: TLS-сессия и TCP-соединение
+            # переиспользуются между запросами вместо нового handshake на каждый
+            authorized_http = google_auth_httplib2.AuthorizedHttp(
+                credentials, http=httplib2.Http(timeout=10)
+            )
+            self.service = build('sheets', 'v4', http=authorized_http, developerKey=GOOGLE_API_KEY)
             logger.info("Google Sheets API подключен")
         except Exception as e:
             logger.error(f"Ошибка подключения к Google Sheets: {e}")
             self.service = None
     
-    def get_sheet_data(self, sheet_name, range_name='A:Z'):
-        """Получение данных из листа"""
+    def _load_cache_snapshot(self):
+        """Загрузка снимка кэша с диска, если он ещё не устарел
+
+        Первый запрос после перезапуска обслуживается из снимка,
+        а не холодным походом в Google Sheets.
+        """
+        try:
+            with open(CACHE_FILE, 'rb') as f:
+                snapshot = pickle.load(f)
+            if time.time() - snapshot['saved_at'] >= CACHE_TTL:
+                return
+            now = time.monotonic()
+            for key, values in snapshot['values'].items():
+                self._cache[key] = (now, values)
+            logger.info("Кэш листов загружен из снимка")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка загрузки снимка кэша: {e}")
+
+    def _save_cache_snapshot(self):
+        """Сохранение снимка кэша на диск (атомарно, через rename)"""
+        snapshot = {
+            'saved_at': time.time(),
+            'values': {key: cached[1] for key, cached in self._cache.items()}
+        }
+        try:
+            with open(CACHE_FILE + '.tmp', 'wb') as f:
+                pickle.dump(snapshot, f)
+            os.replace(CACHE_FILE + '.tmp', CACHE_FILE)
+        except OSError as e:
+            logger.error(f"Ошибка сохранения снимка кэша: {e}")
+
+    def invalidate(self, sheet_name=None):
+        """Сброс кэша листа (или всего кэша, если лист не указан)"""
+        if sheet_name is None:
+            self._cache.clear()
+        else:
+            for key in [k for k in self._cache if k[0] == sheet_name]:
+                del self._cache[key]
+        self._drop_indexes(sheet_name)
+
+    def _drop_indexes(self, sheet_name=None):
+        """Сброс индексов, построенных из указанного листа"""
+        if sheet_name in (None, SHEET_NAMES['admins'], SHEET_NAMES['employees']):
+            self._role_index = None
+            self._name_index = None
+        if sheet_name in (None, SHEET_NAMES['debts']):
+            self._debts_columns = None
+
+    def _ensure_indexes(self):
+        """Построение индексов user_id -> роль/имя из кэшированных листов"""
+        data = self.get_sheets_data_batch([SHEET_NAMES['admins'], SHEET_NAMES['employees']])
+        if self._role_index is not None:
+            return
+
+        role_index = {}
+        name_index = {}
+        for row in data[SHEET_NAMES['employees']][1:]:
+            if len(row) > 0:
+                role_index[str(row[0])] = 'employee'
+                name_index[str(row[0])] = row[1] if len(row) > 1 else "Неизвестный"
+        for row in data[SHEET_NAMES['admins']][1:]:
+            if len(row) > 0:
+                role_index[str(row[0])] = 'admin'
+        self._role_index = role_index
+        self._name_index = name_index
+
+    def _cache_is_fresh(self, sheet_name, range_name=None):
+        """Есть ли в кэше свежая копия листа"""
+        range_name = range_name or SHEET_RANGES.get(sheet_name, 'A:Z')
+        cached = self._cache.get((sheet_name, range_name))
+        return cached is not None and time.monotonic() - cached[0] < CACHE_TTL
+
+    async def prefetch(self, sheet_names):
+        """Асинхронная загрузка устаревших листов в кэш (не блокирует event loop)
+
+        После prefetch синхронные методы работают из памяти, без сети.
+        """
+        missing = [n for n in sheet_names if not self._cache_is_fresh(n)]
+        if not missing:
+            return
+
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=10,
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=4)
+            )
+
+        params = [
+            ('ranges', f"{name}!{SHEET_RANGES.get(name, 'A:Z')}") for name in missing
+        ]
+        params.append(('key', GOOGLE_API_KEY))
+        try:
+            response = await self._http.get(
+                f"{SHEETS_API_BASE}/{SPREADSHEET_ID}/values:batchGet",
+                params=params
+            )
+            response.raise_for_status()
+            value_ranges = response.json().get('valueRanges', [])
+            for name, value_range in zip(missing, value_ranges):
+                values = value_range.get('values', [])
+                cache_key = (name, SHEET_RANGES.get(name, 'A:Z'))
+                self._cache[cache_key] = (time.monotonic(), values)
+                self._drop_indexes(name)
+        except Exception as e:
+            logger.error(f"Ошибка асинхронного чтения листов {missing}: {e}")
+
+    def get_sheet_data(self, sheet_name, range_name=None):
+        """Получение данных из листа (с кэшем на CACHE_TTL секунд)"""
         if not self.service:
             return []
-        
+
+        range_name = range_name or SHEET_RANGES.get(sheet_name, 'A:Z')
+        cache_key = (sheet_name, range_name)
+        cached = self._cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < CACHE_TTL:
+            return cached[1]
+
         try:
             sheet = self.service.spreadsheets()
             result = sheet.values().get(
                 spreadsheetId=SPREADSHEET_ID,
                 range=f"{sheet_name}!{range_name}"
             ).execute()
-            return result.get('values', [])
+            values = result.get('values', [])
+            self._cache[cache_key] = (time.monotonic(), values)
+            self._drop_indexes(sheet_name)
+            return values
         except Exception as e:
             logger.error(f"Ошибка чтения листа {sheet_name}: {e}")
             return []
-    
+
+    def get_sheets_data_batch(self, sheet_names):
+        """Получение данных нескольких листов одним запросом (batchGet)"""
+        if not self.service:
+            return {name: [] for name in sheet_names}
+
+        result = {}
+        missing = []
+        for name in sheet_names:
+            if self._cache_is_fresh(name):
+                result[name] = self._cache[(name, SHEET_RANGES.get(name, 'A:Z'))][1]
+            else:
+                missing.append(name)
+
+        if missing:
+            try:
+                response = self.service.spreadsheets().values().batchGet(
+                    spreadsheetId=SPREADSHEET_ID,
+                    ranges=[f"{name}!{SHEET_RANGES.get(name, 'A:Z')}" for name in missing]
+                ).execute()
+                value_ranges = response.get('valueRanges', [])
+                for name, value_range in zip(missing, value_ranges):
+                    values = value_range.get('values', [])
+                    cache_key = (name, SHEET_RANGES.get(name, 'A:Z'))
+                    self._cache[cache_key] = (time.monotonic(), values)
+                    self._drop_indexes(name)
+                    result[name] = values
+            except Exception as e:
+                logger.error(f"Ошибка пакетного чтения листов {missing}: {e}")
+            for name in missing:
+                result.setdefault(name, [])
+
+        return result
+
     def write_to_sheet(self, sheet_name, values):
         """Запись данных в лист"""
         if not self.service:
             return False
-        
+
         try:
             sheet = self.service.spreadsheets()
             body = {'values': values}
@@ -104,6 +331,8 @@ class DebtBot:
                 valueInputOption='RAW',
                 body=body
             ).execute()
+            self.invalidate(sheet_name)
+            self._save_cache_snapshot()
             return True
         except Exception as e:
             logger.error(f"Ошибка записи в лист {sheet_name}: {e}")
@@ -111,27 +340,13 @@ class DebtBot:
     
     def get_user_role(self, user_id):
         """Определение роли пользователя"""
-        # Проверяем админов
-        admins_data = self.get_sheet_data(SHEET_NAMES['admins'])
-        for row in admins_data[1:]:  # Пропускаем заголовок
-            if len(row) > 0 and str(row[0]) == str(user_id):
-                return 'admin'
-        
-        # Проверяем сотрудников
-        employees_data = self.get_sheet_data(SHEET_NAMES['employees'])
-        for row in employees_data[1:]:  # Пропускаем заголовок
-            if len(row) > 0 and str(row[0]) == str(user_id):
-                return 'employee'
-        
-        return 'unknown'
-    
+        self._ensure_indexes()
+        return self._role_index.get(str(user_id), 'unknown')
+
     def get_employee_name(self, user_id):
         """Получение имени сотрудника по ID"""
-        employees_data = self.get_sheet_data(SHEET_NAMES['employees'])
-        for row in employees_data[1:]:
-            if len(row) > 0 and str(row[0]) == str(user_id):
-                return row[1] if len(row) > 1 else "Неизвестный"
-        return None
+        self._ensure_indexes()
+        return self._name_index.get(str(user_id))
     
     def get_all_employees(self):
         """Получение списка всех сотрудников"""
@@ -145,84 +360,133 @@ class DebtBot:
                 employees.append(row[1])  # Имя сотрудника
         return employees
     
+    @staticmethod
+    def current_billing_month():
+        """Расчетный месяц: текущий с 10-го числа, иначе предыдущий"""
+        today = datetime.now()
+        # Если сегодня число >= 10, то это текущий месяц
+        if today.day >= 10:
+            return today.strftime("%B %Y")
+        # Иначе предыдущий месяц
+        last_month = today.replace(day=1) - timedelta(days=1)
+        return last_month.strftime("%B %Y")
+
+    def _get_debts_columns(self):
+        """Колонки листа debts параллельными списками (дата, сотрудник, позиции, сумма, месяц)
+
+        Суммы распарсены во float один раз при построении; строки с
+        некорректной суммой отбрасываются здесь, а не в каждом фильтре.
+        """
+        debts_data = self.get_sheet_data(SHEET_NAMES['debts'])
+        if self._debts_columns is not None:
+            return self._debts_columns
+
+        dates, employees, items = [], [], []
+        amounts = array('d')
+        emp_ids, month_ids = array('i'), array('i')
+        emp_id_map = {}
+        for row in debts_data[1:]:
+            if len(row) < 4:
+                continue
+            try:
+                amount = float(row[3])
+            except ValueError:
+                logger.warning(f"Пропущена строка debts с некорректной суммой: {row}")
+                continue
+            dates.append(row[0])
+            employees.append(row[1])
+            items.append(row[2])
+            amounts.append(amount)
+            emp_ids.append(emp_id_map.setdefault(row[1], len(emp_id_map)))
+            month_ids.append(_month_key(row[4] if len(row) > 4 else ""))
+
+        self._debts_columns = {
+            'dates': dates,
+            'employees': employees,
+            'items': items,
+            'amounts': amounts,
+            'emp_ids': emp_ids,
+            'month_ids': month_ids,
+            'emp_id_map': emp_id_map,
+        }
+        return self._debts_columns
+
     def calculate_monthly_debt(self, employee_name, month=None):
         """Расчет долга за расчетный период"""
         if not month:
-            today = datetime.now()
-            # Если сегодня число >= 10, то это текущий месяц
-            if today.day >= 10:
-                month = today.strftime("%B %Y")
-            else:
-                # Иначе предыдущий месяц
-                last_month = today.replace(day=1) - timedelta(days=1)
-                month = last_month.strftime("%B %Y")
-        
-        debts_data = self.get_sheet_data(SHEET_NAMES['debts'])
-        if len(debts_data) < 2:
+            month = self.current_billing_month()
+
+        cols = self._get_debts_columns()
+        want_emp = cols['emp_id_map'].get(employee_name, -1)
+        want_month = _month_key(month)
+        if want_emp < 0 or want_month == 0:
             return 0, []
-        
-        total = 0
+
+        total = _aggregate_debts(
+            cols['amounts'], cols['emp_ids'], cols['month_ids'],
+            want_emp, want_month
+        )
+
+        emp_ids, month_ids = cols['emp_ids'], cols['month_ids']
         details = []
-        
-        for row in debts_data[1:]:
-            if len(row) >= 5:  # Проверяем, что есть все нужные колонки
-                debt_employee = row[1] if len(row) > 1 else ""
-                debt_month = row[4] if len(row) > 4 else ""
-                
-                if debt_employee == employee_name and debt_month == month:
-                    try:
-                        amount = float(row[3]) if len(row) > 3 else 0
-                        total += amount
-                        details.append({
-                            'date': row[0] if len(row) > 0 else "",
-                            'items': row[2] if len(row) > 2 else "",
-                            'amount': amount
-                        })
-                    except ValueError:
-                        continue
-        
+        for i in range(len(emp_ids)):
+            if emp_ids[i] == want_emp and month_ids[i] == want_month:
+                details.append({
+                    'date': cols['dates'][i],
+                    'items': cols['items'][i],
+                    'amount': cols['amounts'][i]
+                })
+
         return total, details
-    
+
+    def get_month_totals(self, month=None):
+        """Суммы долгов всех сотрудников за месяц одним проходом"""
+        if not month:
+            month = self.current_billing_month()
+
+        cols = self._get_debts_columns()
+        want_month = _month_key(month)
+        employees, month_ids = cols['employees'], cols['month_ids']
+        amounts = cols['amounts']
+
+        totals = defaultdict(float)
+        for i in range(len(amounts)):
+            if month_ids[i] == want_month:
+                totals[employees[i]] += amounts[i]
+        return totals
+
     def get_daily_debts(self, date, employee_name=None):
         """Получение долгов за конкретный день"""
-        debts_data = self.get_sheet_data(SHEET_NAMES['debts'])
-        if len(debts_data) < 2:
-            return []
-        
+        cols = self._get_debts_columns()
+        dates, employees = cols['dates'], cols['employees']
         daily_debts = []
-        for row in debts_data[1:]:
-            if len(row) >= 4:
-                debt_date = row[0] if len(row) > 0 else ""
-                debt_employee = row[1] if len(row) > 1 else ""
-                
-                if debt_date == date:
-                    if employee_name and debt_employee != employee_name:
-                        continue
-                    
-                    try:
-                        amount = float(row[3]) if len(row) > 3 else 0
-                        daily_debts.append({
-                            'employee': debt_employee,
-                            'items': row[2] if len(row) > 2 else "",
-                            'amount': amount
-                        })
-                    except ValueError:
-                        continue
-        
+
+        for i in range(len(dates)):
+            if dates[i] != date:
+                continue
+            if employee_name and employees[i] != employee_name:
+                continue
+            daily_debts.append({
+                'employee': employees[i],
+                'items': cols['items'][i],
+                'amount': cols['amounts'][i]
+            })
+
         return daily_debts
     
     def get_all_debts_summary(self, month=None):
         """Общая сумма долгов всех сотрудников за период"""
-        employees = self.get_all_employees()
+        # Один проход по листу debts вместо повторного чтения на каждого сотрудника
+        totals = self.get_month_totals(month)
+
         total = 0
         summary = []
-        
-        for employee in employees:
-            employee_total, _ = self.calculate_monthly_debt(employee, month)
+        for employee in self.get_all_employees():
+            employee_total = totals.get(employee, 0)
             if employee_total > 0:
                 total += employee_total
                 summary.append(f"{employee}: {employee_total} ₽")
-        
+
         return total, summary
 
 # Создаем экземпляр бота
@@ -230,13 +494,55 @@ bot = DebtBot()
 
 # ==================== HANDLERS ====================
 
+# Меню неизменны для каждой роли — собираем их один раз при загрузке модуля
+ADMIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👥 Общая сумма долгов", callback_data='all_debts')],
+    [InlineKeyboardButton("👤 Долг сотрудника", callback_data='employee_debt')],
+    [InlineKeyboardButton("🔍 Позиции за день", callback_data='daily_items')],
+    [InlineKeyboardButton("📢 Разослать уведомления", callback_data='send_notifications')],
+    [InlineKeyboardButton("ℹ️ Справка", callback_data='help')]
+])
+EMPLOYEE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Мой долг (общая сумма)", callback_data='my_debt_total')],
+    [InlineKeyboardButton("📅 Долг за конкретный день", callback_data='my_debt_daily')],
+    [InlineKeyboardButton("📋 Детализация с начала периода", callback_data='my_debt_details')],
+    [InlineKeyboardButton("ℹ️ Справка", callback_data='help')]
+])
+BACK_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("↩️ Назад", callback_data='back')]
+])
+
+async def _get_cached_role(user_id, context):
+    """Роль пользователя из user_data (с TTL), при устаревании — из Sheets
+
+    Имя сотрудника кэшируется рядом с ролью, чтобы обработчики
+    не искали его заново.
+    """
+    now = time.time()
+    role = context.user_data.get('role')
+    if role is not None and now - context.user_data.get('_role_ts', 0) < ROLE_CACHE_TTL:
+        return role
+
+    await bot.prefetch([SHEET_NAMES['admins'], SHEET_NAMES['employees']])
+    role = bot.get_user_role(user_id)
+    context.user_data['role'] = role
+    context.user_data['_role_ts'] = now
+    context.user_data['employee_name'] = bot.get_employee_name(user_id)
+    return role
+
+def _menu_for_role(role):
+    """Текст и клавиатура меню для уже известной роли"""
+    if role == 'admin':
+        return "👑 Администратор\nВыберите действие:", ADMIN_MARKUP
+    return "👤 Сотрудник\nВыберите действие:", EMPLOYEE_MARKUP
+
 async def start(update: Update, context):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
     
     # Проверяем, зарегистрирован ли пользователь
-    role = bot.get_user_role(user_id)
-    
+    role = await _get_cached_role(user_id, context)
+
     if role == 'unknown':
         await update.message.reply_text(
             "❌ Вы не найдены в системе.\n"
@@ -245,25 +551,7 @@ async def start(update: Update, context):
         return
     
     # Показываем соответствующее меню
-    if role == 'admin':
-        keyboard = [
-            [InlineKeyboardButton("👥 Общая сумма долгов", callback_data='all_debts')],
-            [InlineKeyboardButton("👤 Долг сотрудника", callback_data='employee_debt')],
-            [InlineKeyboardButton("🔍 Позиции за день", callback_data='daily_items')],
-            [InlineKeyboardButton("📢 Разослать уведомления", callback_data='send_notifications')],
-            [InlineKeyboardButton("ℹ️ Справка", callback_data='help')]
-        ]
-        text = "👑 Администратор\nВыберите действие:"
-    else:  # employee
-        keyboard = [
-            [InlineKeyboardButton("📊 Мой долг (общая сумма)", callback_data='my_debt_total')],
-            [InlineKeyboardButton("📅 Долг за конкретный день", callback_data='my_debt_daily')],
-            [InlineKeyboardButton("📋 Детализация с начала периода", callback_data='my_debt_details')],
-            [InlineKeyboardButton("ℹ️ Справка", callback_data='help')]
-        ]
-        text = "👤 Сотрудник\nВыберите действие:"
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text, reply_markup = _menu_for_role(role)
     await update.message.reply_text(text, reply_markup=reply_markup)
 
 async def button_handler(update: Update, context):
@@ -272,8 +560,8 @@ async def button_handler(update: Update, context):
     await query.answer()
     
     user_id = update.effective_user.id
-    role = bot.get_user_role(user_id)
-    
+    role = await _get_cached_role(user_id, context)
+
     if query.data == 'help':
         await show_help(query)
         return
@@ -290,53 +578,56 @@ async def admin_button_handler(query, context):
     elif query.data == 'employee_debt':
         await query.edit_message_text(
             "Введите имя сотрудника (например: Иванов Иван):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Назад", callback_data='back')]])
+            reply_markup=BACK_MARKUP
         )
         context.user_data['action'] = 'employee_debt'
         return SELECTING_ACTION
     elif query.data == 'daily_items':
         await query.edit_message_text(
             "Введите дату в формате ДД.ММ.ГГГГ (например: 15.12.2024):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Назад", callback_data='back')]])
+            reply_markup=BACK_MARKUP
         )
         context.user_data['action'] = 'daily_items'
         return SELECTING_ACTION
     elif query.data == 'send_notifications':
         await send_notifications(query)
     elif query.data == 'back':
-        await start_from_query(query)
+        await start_from_query(query, context)
 
 async def employee_button_handler(query, context):
     """Обработчик кнопок для сотрудников"""
-    employee_name = bot.get_employee_name(update.effective_user.id)
+    employee_name = context.user_data.get('employee_name')
     if not employee_name:
         await query.edit_message_text("❌ Ошибка: ваше имя не найдено в базе")
         return
     
     if query.data == 'my_debt_total':
+        await bot.prefetch([SHEET_NAMES['debts']])
         total, details = bot.calculate_monthly_debt(employee_name)
         month = datetime.now().strftime("%B %Y")
         
-        message = f"📊 Ваш долг за {month}:\n"
-        message += f"💵 Общая сумма: {total} ₽\n\n"
-        
+        parts = [
+            f"📊 Ваш долг за {month}:\n",
+            f"💵 Общая сумма: {total} ₽\n\n"
+        ]
+
         if details:
-            message += "📋 Последние операции:\n"
+            parts.append("📋 Последние операции:\n")
             for i, detail in enumerate(details[-5:], 1):  # Последние 5 операций
-                message += f"{i}. {detail['date']}: {detail['items']} - {detail['amount']} ₽\n"
-        
-        await query.edit_message_text(message)
+                parts.append(f"{i}. {detail['date']}: {detail['items']} - {detail['amount']} ₽\n")
+
+        await query.edit_message_text("".join(parts))
         
     elif query.data == 'my_debt_daily':
         await query.edit_message_text(
             "Введите дату в формате ДД.ММ.ГГГГ (например: 15.12.2024):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Назад", callback_data='back')]])
+            reply_markup=BACK_MARKUP
         )
         context.user_data['action'] = 'my_debt_daily'
-        context.user_data['employee_name'] = employee_name
         return SELECTING_ACTION
         
     elif query.data == 'my_debt_details':
+        await bot.prefetch([SHEET_NAMES['debts']])
         total, details = bot.calculate_monthly_debt(employee_name)
         month = datetime.now().strftime("%B %Y")
         
@@ -344,52 +635,57 @@ async def employee_button_handler(query, context):
             await query.edit_message_text(f"📭 У вас нет долгов за {month}")
             return
         
-        message = f"📋 Детализация долга за {month}:\n\n"
+        parts = [f"📋 Детализация долга за {month}:\n\n"]
         running_total = 0
-        
+
         for detail in details:
             running_total += detail['amount']
-            message += f"📅 {detail['date']}\n"
-            message += f"   🛒 {detail['items']}\n"
-            message += f"   💰 {detail['amount']} ₽ (Накоплено: {running_total} ₽)\n\n"
-        
-        message += f"✅ Итого: {total} ₽"
-        await query.edit_message_text(message)
+            parts.append(f"📅 {detail['date']}\n")
+            parts.append(f"   🛒 {detail['items']}\n")
+            parts.append(f"   💰 {detail['amount']} ₽ (Накоплено: {running_total} ₽)\n\n")
+
+        parts.append(f"✅ Итого: {total} ₽")
+        await query.edit_message_text("".join(parts))
 
 async def show_all_debts(query):
     """Показ общей суммы долгов всех сотрудников"""
+    await bot.prefetch([SHEET_NAMES['debts'], SHEET_NAMES['employees']])
     total, summary = bot.get_all_debts_summary()
     month = datetime.now().strftime("%B %Y")
     
-    message = f"👥 Общие долги за {month}:\n"
-    message += f"💵 Общая сумма: {total} ₽\n\n"
-    
+    parts = [
+        f"👥 Общие долги за {month}:\n",
+        f"💵 Общая сумма: {total} ₽\n\n"
+    ]
+
     if summary:
-        message += "📋 По сотрудникам:\n"
+        parts.append("📋 По сотрудникам:\n")
         for item in summary:
-            message += f"• {item}\n"
+            parts.append(f"• {item}\n")
     else:
-        message += "📭 Долгов нет"
-    
-    await query.edit_message_text(message)
+        parts.append("📭 Долгов нет")
+
+    await query.edit_message_text("".join(parts))
 
 async def send_notifications(query):
     """Рассылка уведомлений сотрудникам"""
     await query.edit_message_text("⏳ Начинаю рассылку уведомлений...")
     
+    await bot.prefetch([SHEET_NAMES['employees'], SHEET_NAMES['debts']])
     employees_data = bot.get_sheet_data(SHEET_NAMES['employees'])
     notified = 0
     errors = 0
-    
+
+    # Один проход по листу debts вместо calculate_monthly_debt на каждого сотрудника
+    totals = bot.get_month_totals()
+
     for row in employees_data[1:]:
         if len(row) >= 2:
             try:
                 employee_id = int(row[0])
                 employee_name = row[1]
-                
-                # Рассчитываем долг
-                total, _ = bot.calculate_monthly_debt(employee_name)
-                
+                total = totals.get(employee_name, 0)
+
                 if total > 0:
                     # В реальном боте здесь была бы отправка сообщения
                     # await context.bot.send_message(employee_id, f"Ваш долг: {total} ₽")
@@ -433,63 +729,72 @@ async def handle_text(update: Update, context):
     
     if action == 'employee_debt':
         # Поиск долга сотрудника
+        await bot.prefetch([SHEET_NAMES['debts']])
         total, details = bot.calculate_monthly_debt(text)
         month = datetime.now().strftime("%B %Y")
         
-        message = f"👤 Долг сотрудника {text} за {month}:\n"
-        message += f"💵 Общая сумма: {total} ₽\n\n"
-        
+        parts = [
+            f"👤 Долг сотрудника {text} за {month}:\n",
+            f"💵 Общая сумма: {total} ₽\n\n"
+        ]
+
         if details:
-            message += "📋 Последние операции:\n"
+            parts.append("📋 Последние операции:\n")
             for i, detail in enumerate(details[-5:], 1):
-                message += f"{i}. {detail['date']}: {detail['items']} - {detail['amount']} ₽\n"
+                parts.append(f"{i}. {detail['date']}: {detail['items']} - {detail['amount']} ₽\n")
         else:
-            message += "📭 Долгов нет"
-        
-        await update.message.reply_text(message)
-        await start_from_message(update)
+            parts.append("📭 Долгов нет")
+
+        await update.message.reply_text("".join(parts))
+        await start_from_message(update, context)
         
     elif action == 'daily_items':
         # Позиции за день
+        await bot.prefetch([SHEET_NAMES['debts']])
         daily_debts = bot.get_daily_debts(text)
         
         if not daily_debts:
             await update.message.reply_text(f"📭 За {text} долгов не найдено")
         else:
-            message = f"🔍 Позиции за {text}:\n\n"
+            parts = [f"🔍 Позиции за {text}:\n\n"]
             for debt in daily_debts:
-                message += f"👤 {debt['employee']}\n"
-                message += f"   🛒 {debt['items']}\n"
-                message += f"   💰 {debt['amount']} ₽\n\n"
-            
-            await update.message.reply_text(message)
-        await start_from_message(update)
+                parts.append(f"👤 {debt['employee']}\n")
+                parts.append(f"   🛒 {debt['items']}\n")
+                parts.append(f"   💰 {debt['amount']} ₽\n\n")
+
+            await update.message.reply_text("".join(parts))
+        await start_from_message(update, context)
         
     elif action == 'my_debt_daily':
         # Долг сотрудника за конкретный день
         employee_name = context.user_data.get('employee_name')
+        await bot.prefetch([SHEET_NAMES['debts']])
         daily_debts = bot.get_daily_debts(text, employee_name)
         
         if not daily_debts:
             await update.message.reply_text(f"📭 За {text} у вас нет долгов")
         else:
             total = sum(debt['amount'] for debt in daily_debts)
-            message = f"📅 Ваши долги за {text}:\n"
-            message += f"💵 Общая сумма: {total} ₽\n\n"
-            
+            parts = [
+                f"📅 Ваши долги за {text}:\n",
+                f"💵 Общая сумма: {total} ₽\n\n"
+            ]
+
             for debt in daily_debts:
-                message += f"🛒 {debt['items']} - {debt['amount']} ₽\n"
-            
-            await update.message.reply_text(message)
-        await start_from_message(update)
+                parts.append(f"🛒 {debt['items']} - {debt['amount']} ₽\n")
 
-async def start_from_query(query):
-    """Возврат в меню из callback query"""
-    await start(query.update, query.update.callback_query)
+            await update.message.reply_text("".join(parts))
+        await start_from_message(update, context)
 
-async def start_from_message(update):
-    """Возврат в меню из message"""
-    await start(update, update)
+async def start_from_query(query, context):
+    """Возврат в меню из callback query — роль уже лежит в user_data"""
+    text, reply_markup = _menu_for_role(context.user_data.get('role'))
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def start_from_message(update, context):
+    """Возврат в меню из message — роль уже лежит в user_data"""
+    text, reply_markup = _menu_for_role(context.user_data.get('role'))
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
 async def error_handler(update: Update, context):
     """Обработчик ошибок"""
@@ -501,35 +806,25 @@ async def error_handler(update: Update, context):
 
 # ==================== SCHEDULER ====================
 
-def send_scheduled_notifications():
-    """Планировщик для отправки уведомлений 10-го числа"""
-    if not ENABLE_NOTIFICATIONS:
-        return
-    
-    today = datetime.now()
-    if today.day == 10:
+async def send_scheduled_notifications(context):
+    """Ежедневная задача: уведомления рассылаются 10-го числа"""
+    if datetime.now().day == 10:
         # Здесь будет логика рассылки
         logger.info(f"Время рассылки уведомлений: {NOTIFICATION_HOUR}:00")
 
-def scheduler_thread():
-    """Поток для планировщика"""
-    schedule.every().day.at(f"{NOTIFICATION_HOUR:02d}:00").do(send_scheduled_notifications)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
-
 # ==================== MAIN ====================
 
 def main():
     """Основная функция"""
-    # Запускаем планировщик в отдельном потоке
-    if ENABLE_NOTIFICATIONS:
-        thread = Thread(target=scheduler_thread, daemon=True)
-        thread.start()
-    
     # Создаем приложение
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
+
+    # Ежедневная задача в event loop вместо отдельного потока с опросом раз в минуту
+    if ENABLE_NOTIFICATIONS:
+        application.job_queue.run_daily(
+            send_scheduled_notifications,
+            time=dt_time(hour=NOTIFICATION_HOUR)
+        )
     
     # Conversation handler для текстовых ответов
     conv_handler = ConversationHandler(
@@ -543,10 +838,9 @@ def main():
         fallbacks=[CommandHandler('start', start)]
     )
     
-    # Регистрируем обработчики
+    # Регистрируем обработчики (callback-кнопки обрабатывает ConversationHandler)
     application.add_handler(CommandHandler('start', start))
     application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(button_handler))
     application.add_error_handler(error_handler)
     
     # Запускаем бота